@@ -28,24 +28,182 @@ Initial usage
 import sys
 import os
 import subprocess
-import getpass
-import uuid
+import glob
+import heapq
 import json
-from random import randint
+import random
 import re
 import argparse
-from threading import Thread
-from queue import Queue
-import tempfile
-import ssl
+import functools
+import shlex
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
-try:
-    import urllib.request
-except ImportError:
+
+if sys.version_info[0] < 3:
     sys.exit("Sorry, this script requires python 3.x")
 
+# ssl, urllib, asyncio, tempfile, uuid and getpass are imported where they are used so
+# that quick commands such as `pypia -d` don't pay for loading them
+
 logger = logging.getLogger(__name__)
 
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pypia')
+
+_KEYFILE_TEMPLATE = '\n'.join([
+    '[connection]', 'id=PIA - {name}', 'uuid={uuid}', 'type=vpn', 'autoconnect=false',
+    '\n', '[vpn]', 'service-type=org.freedesktop.NetworkManager.openvpn',
+    'username={username}', 'comp-lzo=yes', 'remote={remote}', 'connection-type=password',
+    'password-flags=0', 'ca=/etc/openvpn/ca.rsa.2048.crt', 'port={port}',
+    'auth={auth}', 'cipher={cipher}', '\n', '[vpn-secrets]',
+    'password={password}', '\n', '[ipv4]', 'method=auto',
+    'dns=209.222.18.222;209.222.18.218;',
+    'ignore-auto-dns=true', '\n', '[ipv6]', 'method=ignore'])
+
+_FPING_RE = re.compile(r'^(\S+)\s*:\s*(.+)$', re.M)
+
+
+def _spawn_all(argvs):
+    """
+    Start every command in `argvs` with posix_spawnp, avoiding a fork, then
+    wait for all of them and return their exit codes.
+    """
+    if not hasattr(os, 'posix_spawnp'):
+        # python < 3.8
+        procs = [subprocess.Popen(argv) for argv in argvs]
+        return [proc.wait() for proc in procs]
+    pids = [os.posix_spawnp(argv[0], argv, os.environ) for argv in argvs]
+    return [_exit_code(os.waitpid(pid, 0)[1]) for pid in pids]
+
+
+def _exit_code(status):
+    """Convert a waitpid status to an exit code, negative if killed by a signal."""
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return -os.WTERMSIG(status)
+
+
+def _spawn(argv):
+    """Run `argv` with posix_spawnp and return its exit code."""
+    return _spawn_all([argv])[0]
+
+
+def _write_private(path, data):
+    """Write bytes `data` to `path`, creating it readable by its owner only."""
+    # create with final permissions so the contents are never exposed
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def _render_keyfile(server, username, password, cipher='AES-128-CBC', auth='SHA1', port='1198',
+                    con_uuid=None):
+    """Returns the NetworkManager keyfile for one PIA `server` dict."""
+    if con_uuid is None:
+        import uuid
+        con_uuid = uuid.uuid4()
+    return _KEYFILE_TEMPLATE.format(
+        name=server['name'], uuid=con_uuid, username=username,
+        remote=server['openvpn_tcp']['best'].split(':')[0],
+        port=port, auth=auth, cipher=cipher, password=password)
+
+
+def _write_atomic(path, data):
+    """Write `data` to `path` via a temporary file and rename."""
+    import tempfile
+    dir_name = os.path.dirname(path)
+    os.makedirs(dir_name, exist_ok=True)
+    with tempfile.NamedTemporaryFile(mode='w', dir=dir_name, delete=False) as ntf:
+        ntf.write(data)
+    os.replace(ntf.name, path)
+
+
+@functools.lru_cache(maxsize=1)
+def _list_pia_connections(sys_cons, mtime):
+    """
+    Scans `sys_cons` once and sorts the PIA keyfiles into the 'us', 'int' and
+    'all' regions.
+    """
+    regions = {'us': [], 'int': [], 'all': []}
+    with os.scandir(sys_cons) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.startswith('PIA - '):
+                continue
+            regions['all'].append(name)
+            if name.startswith('PIA - US'):
+                regions['us'].append(name)
+            if 'US' not in name:
+                regions['int'].append(name)
+    return {k: tuple(v) for k, v in regions.items()}
+
+
+class _FirstLine():
+    """
+    Read-only file wrapper that stops at the first newline, since the PIA
+    server info is one line of JSON followed by a non-JSON trailer.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.done = False
+
+    def read(self, size=-1):
+        # ijson probes with read(0) to tell bytes from str streams
+        if self.done or size == 0:
+            return b''
+        data = self.fileobj.readline(size)
+        if data.endswith(b'\n') or not data:
+            self.done = True
+            data = data.rstrip(b'\n')
+        return data
+
+
+def _parse_configs(fileobj):
+    """
+    Parses the PIA server info from `fileobj`, keeping only the server entries.
+    The optional `ijson` package is used to stream the response when present.
+    """
+    ijson = _streaming_ijson()
+    if ijson is None:
+        configs_dict = json.loads(fileobj.read().decode('utf-8').split('\n')[0])
+        return {k: v for k, v in configs_dict.items() if isinstance(v, dict) and v.get('dns')}
+    return {k: v for k, v in ijson.kvitems(_FirstLine(fileobj), '', use_float=True)
+            if isinstance(v, dict) and v.get('dns')}
+
+
+def _streaming_ijson():
+    """Returns the `ijson` module if it is installed and new enough, else None."""
+    try:
+        import ijson
+    except ImportError:
+        return None
+    # kvitems and use_float need ijson 3.1+, older distro packages lack them
+    try:
+        version = tuple(int(i) for i in getattr(ijson, '__version__', '0').split('.')[:2])
+    except ValueError:
+        return None
+    if not hasattr(ijson, 'kvitems') or version < (3, 1):
+        return None
+    return ijson
+
+
+@functools.lru_cache(maxsize=1)
+def _load_package_info():
+    if __package__:
+        import importlib.resources
+        if not hasattr(importlib.resources, 'files'):
+            # python < 3.9
+            return json.loads(importlib.resources.read_text(__package__, 'package_info.json'))
+        return json.loads(importlib.resources.files(__package__)
+                          .joinpath('package_info.json').read_text())
+    # run as a script, e.g. `python3 pypia/pypia.py` from a clone
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'package_info.json'), 'r') as f:
+        return json.load(f)
+
 
 class Distro():
     """
@@ -58,17 +216,22 @@ class Distro():
         self.get_package_info()
 
     def get_distro(self):
-        os_release = subprocess.check_output(['cat', '/etc/os-release']) \
-            .decode('utf-8').splitlines()
-        self.os_dict = {i.split('=')[0]: i.split('=')[1].strip('"')
-                        for i in os_release if '=' in i}
+        with open('/etc/os-release', 'r') as f:
+            os_release = f.read().splitlines()
+        self.os_dict = {}
+        for line in os_release:
+            key, sep, value = line.partition('=')
+            if not sep or key.startswith('#'):
+                continue
+            try:
+                # values use shell quoting rules, see os-release(5)
+                self.os_dict[key] = ''.join(shlex.split(value))
+            except ValueError:
+                self.os_dict[key] = value.strip('"\'')
         self.distro = self.os_dict['ID'].lower()
 
     def get_package_info(self):
-        json_path_list = os.path.abspath(__file__).split('/')[:-1] + ['package_info.json']
-        json_path = os.path.join(*json_path_list)
-        with open('/' + json_path, 'r') as package_info:
-            package_dict = json.load(package_info)
+        package_dict = _load_package_info()
         self.required_packages = package_dict['required_packages'].get(self.distro)
         self.install_command = package_dict['install_commands'].get(self.distro)
         if not self.required_packages:
@@ -80,13 +243,14 @@ class Distro():
         for package in self.required_packages:
             raw = input('Installing {}. OK? (y/n): '.format(package))
             if (raw.lower() == 'y') | (raw.lower() == 'yes'):
-                subprocess.call(['sudo'] + [i for i in self.install_command.format(package).split()])
+                if _spawn(['sudo'] + [i.format(package) for i in self.install_command]) != 0:
+                    sys.exit('\n{} could not be installed. Exiting.\n'.format(package))
             else:
                 sys.exit('\n{} required. Exiting.\n'.format(package))
 
     def restart_network_manager(self):
         print('Restarting network manager...')
-        subprocess.call(['sudo', 'systemctl', 'restart', 'NetworkManager.service'])
+        _spawn(['sudo', 'systemctl', 'restart', 'NetworkManager.service'])
 
 
 class PiaConfigurations():
@@ -98,15 +262,29 @@ class PiaConfigurations():
     -----
     The credentials are stored in the VPN keyfiles in
     `/etc/NetworkManager/system-connections/`.
+
+    The PIA server info is cached in `CACHE_DIR` and reused without any
+    request for `cache_ttl` seconds. After that it is revalidated with its
+    ETag/Last-Modified, so an unchanged list isn't downloaded again. Pass
+    `refresh=True` to ignore the cache and download it again.
     """
 
-    def __init__(self):
+    cache_ttl = 300
+    # the PIA CA rotates on the order of years
+    cert_max_age = 30 * 86400
+
+    def __init__(self, refresh=False):
         self.cert_address = 'https://www.privateinternetaccess.com/openvpn/ca.rsa.2048.crt'
         self.config_address = 'https://privateinternetaccess.com/vpninfo/servers'
         self.config_dir = '/etc/NetworkManager/system-connections/'
+        self.cert_file = '/etc/openvpn/ca.rsa.2048.crt'
+        self.config_cache = os.path.join(CACHE_DIR, 'servers.json')
+        self.config_meta = self.config_cache + '.meta'
+        self.refresh = refresh
         self.get_vpn_configs()
 
     def get_credentials(self):
+        import getpass
         self.username = input('\nEnter your PIA username: ')
         while True:
             self.password = getpass.getpass(prompt='Enter your password: ')
@@ -116,44 +294,157 @@ class PiaConfigurations():
             print("\nPasswords do not match. Please try again.")
 
     def copy_cert(self):
+        import urllib.error
+        try:
+            st = os.stat(self.cert_file)
+            if st.st_size > 0 and time.time() - st.st_mtime < self.cert_max_age:
+                print('\nPIA certificate in /etc/openvpn/ is up to date.')
+                return
+        except OSError:
+            pass
         try:
             print('\nDownloading PIA certificate...')
-            if not os.path.exists('/etc/openvpn/'):
-                subprocess.call(['sudo', 'mkdir', '/etc/openvpn'])
-            subprocess.call(['sudo', 'curl', '--url', self.cert_address, '-o', '/etc/openvpn/ca.rsa.2048.crt'])
-            if os.path.exists('/etc/openvpn/ca.rsa.2048.crt'):
+            if os.geteuid() == 0:
+                os.makedirs(os.path.dirname(self.cert_file), exist_ok=True)
+                self.download_cert()
+            else:
+                if not os.path.exists('/etc/openvpn/'):
+                    subprocess.call(['sudo', 'mkdir', '-p', '/etc/openvpn'])
+                # -z only fetches the cert if it is newer than the local copy
+                subprocess.call(['sudo', 'curl', '--url', self.cert_address, '-z', self.cert_file,
+                                 '-o', self.cert_file])
+            if os.path.exists(self.cert_file):
                 print('PIA certificate downloaded and saved to /etc/openvpn/')
         except urllib.error.URLError:
             sys.exit('\nPIA cert was not able to be downloaded and saved. ' +
                      'This script needs an internet connection to be able to' +
                      'fetch it automatically. Exiting.\n')
 
-    def get_vpn_configs(self):
+    def download_cert(self):
+        import email.utils
+        import urllib.request
+        req = urllib.request.Request(self.cert_address)
+        if os.path.exists(self.cert_file):
+            req.add_header('If-Modified-Since',
+                           email.utils.formatdate(os.path.getmtime(self.cert_file), usegmt=True))
+        try:
+            with urllib.request.urlopen(req) as url:
+                cert = url.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return
+            raise
+        with open(self.cert_file, 'wb') as f:
+            f.write(cert)
+
+    def _fetch_configs(self, req, context=None):
+        import urllib.request
+        try:
+            with urllib.request.urlopen(req, context=context) as url:
+                return _parse_configs(url), url.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None, e.headers
+            raise
+
+    def download_vpn_configs(self, etag=None, last_modified=None):
+        """
+        Returns the parsed server info and the response headers. The server
+        info is None when it is unchanged since `etag`/`last_modified`.
+        """
+        import ssl
+        import urllib.request
+        req = urllib.request.Request(self.config_address)
+        if etag:
+            req.add_header('If-None-Match', etag)
+        if last_modified:
+            req.add_header('If-Modified-Since', last_modified)
         try:
-            with urllib.request.urlopen(self.config_address) as url:
-                config_json = url.read().decode('utf-8').split('\n')[0]
+            return self._fetch_configs(req)
         except urllib.error.URLError:
             logger.warning('\nWARNING: There may have been an issue with certificate ' +
                            'verification to the PIA server info page. Trying to ' +
                            'bypass cert check that python performs since PEP 476.\n')
             try:
-                context = ssl._create_unverified_context()
-                with urllib.request.urlopen(self.config_address, context=context) as url:
-                    config_json = url.read().decode('utf-8').split('\n')[0]
+                return self._fetch_configs(req, context=ssl._create_unverified_context())
             except urllib.error.URLError:
                 sys.exit('\nPIA VPN configurations were not able to be downloaded.' +
                          'This script needs an internet connection to be able to ' +
                          'fetch them automatically. Exiting.\n')
-        configs_dict = json.loads(config_json)
+
+    def _cached_configs(self, ttl=None):
+        ttl = self.cache_ttl if ttl is None else ttl
+        cached = None
+        meta = {}
+        if not self.refresh:
+            try:
+                with open(self.config_cache, 'r') as f:
+                    cached = json.load(f)
+                with open(self.config_meta, 'r') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                pass
+            if cached is not None and time.time() - meta.get('fetched', 0) < ttl:
+                return cached
+        if cached is None:
+            meta = {}
+        configs_dict, headers = self.download_vpn_configs(meta.get('etag'), meta.get('last_modified'))
+        if configs_dict is None:
+            # unchanged on the server, so only restart the freshness window
+            configs_dict = cached
+        else:
+            meta = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        meta['fetched'] = time.time()
+        try:
+            if configs_dict is not cached:
+                _write_atomic(self.config_cache, json.dumps(configs_dict))
+            _write_atomic(self.config_meta, json.dumps(meta))
+        except OSError:
+            logger.warning('Unable to cache PIA server info in {}'.format(CACHE_DIR))
+        return configs_dict
+
+    def get_vpn_configs(self):
+        configs_dict = self._cached_configs()
         self.configs_dict = {k: v for k, v in configs_dict.items() if isinstance(v, dict) and v.get('dns')}
 
-    def delete_old_configs(self):
-        config_list = subprocess.check_output(['sudo', 'ls', self.config_dir]).decode('utf-8').split('\n')
-        if any([i for i in config_list if i.startswith('PIA - ')]):
+    def render_all_keyfiles(self, **kwargs):
+        """Returns a (path, contents) pair for the keyfile of every PIA server."""
+        import uuid
+        # one read of the random source for all the connection uuids
+        raw = os.urandom(16 * len(self.configs_dict))
+        return [(os.path.join(self.config_dir, 'PIA - ' + server['name']),
+                 _render_keyfile(server, self.username, self.password,
+                                 con_uuid=uuid.UUID(bytes=raw[16 * i:16 * (i + 1)], version=4),
+                                 **kwargs).encode('utf-8'))
+                for i, server in enumerate(self.configs_dict.values())]
+
+    def write_keyfiles(self, jobs=None, **kwargs):
+        keyfiles = self.render_all_keyfiles(**kwargs)
+        if os.geteuid() != 0:
+            # only root can write to `config_dir` directly, so stage the keyfiles in a
+            # private temp dir and install them all with one sudo call (one password prompt)
+            import tempfile
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                staged = []
+                for path, data in keyfiles:
+                    staged.append(os.path.join(tmp_dir, os.path.basename(path)))
+                    _write_private(staged[-1], data)
+                subprocess.call(['sudo', 'install', '-m', '0600', '--'] + staged + [self.config_dir])
+            finally:
+                shutil.rmtree(tmp_dir)
+            return
+        # os.write releases the GIL, so threads overlap the writes
+        with ThreadPoolExecutor(max_workers=jobs) as ex:
+            list(ex.map(lambda keyfile: _write_private(*keyfile), keyfiles))
+
+    def delete_old_configs(self, chunk_size=1000):
+        old_configs = glob.glob(os.path.join(glob.escape(self.config_dir), 'PIA - *'))
+        if old_configs:
             print('Deleting old PIA config files...')
-            for f in config_list:
-                if f.startswith('PIA - '):
-                    subprocess.call(['sudo', 'rm', '{}{}'.format(self.config_dir, f)])
+            # remove in chunks to stay well below ARG_MAX
+            for i in range(0, len(old_configs), chunk_size):
+                subprocess.check_call(['sudo', 'rm', '--'] + old_configs[i:i + chunk_size])
 
 
 class Keyfile():
@@ -172,21 +463,14 @@ class Keyfile():
         self.create_keyfile()
 
     def define_keyfile(self, username, password):
-        l = ['[connection]', 'id={}{}', 'uuid={}', 'type=vpn', 'autoconnect=false',
-             '\n', '[vpn]', 'service-type=org.freedesktop.NetworkManager.openvpn',
-             'username={}', 'comp-lzo=yes', 'remote={}', 'connection-type=password',
-             'password-flags=0', 'ca=/etc/openvpn/ca.rsa.2048.crt', 'port={}',
-             'auth={}', 'cipher={}', '\n', '[vpn-secrets]',
-             'password={}', '\n', '[ipv4]', 'method=auto',
-             'dns=209.222.18.222;209.222.18.218;',
-             'ignore-auto-dns=true', '\n', '[ipv6]', 'method=ignore']
-        self.keyfile_string = '\n'.join(l).format('PIA - ', self.configs[1]['name'],
-                                                  uuid.uuid4(), username,
-                                                  self.configs[1]['openvpn_tcp']['best'].split(':')[0],
-                                                  self.port, self.auth, self.cipher,
-                                                  password)
+        self.keyfile_string = _render_keyfile(self.configs[1], username, password,
+                                              port=self.port, auth=self.auth, cipher=self.cipher)
 
     def create_keyfile(self):
+        import tempfile
+        if os.geteuid() == 0:
+            _write_private(self.config_file, self.keyfile_string.encode('utf-8'))
+            return
         with tempfile.NamedTemporaryFile(mode='w') as ntf:
             ntf.write(self.keyfile_string)
             ntf.seek(0)
@@ -206,106 +490,235 @@ class Connection():
 
     def __init__(self, region):
         self.region = region
+        self.active_pia = set()
 
     def get_pia_connections(self):
-        if self.region == 'us':
-            search_term = 'PIA - US'
-        else:
-            search_term = 'PIA - '
         sys_cons = '/etc/NetworkManager/system-connections/'
-        if self.region == 'int':
-            self.cons = [i for i in os.listdir(sys_cons) if (search_term in i) & ('US' not in i)]
-        else:
-            self.cons = [i for i in os.listdir(sys_cons) if search_term in i]
-
-    def pick_rand_con(self):
-        return self.cons[randint(0, len(self.cons) - 1)]
+        # the directory mtime changes whenever keyfiles are added or removed
+        self.cons = list(_list_pia_connections(sys_cons, os.stat(sys_cons).st_mtime)[self.region])
 
     def make_connection(self, con):
         print('Activating {}...'.format(con))
-        subprocess.call(['nmcli', 'con', 'up', 'id', con])
+        _spawn(['nmcli', 'con', 'up', 'id', con])
 
     def connect_random_vpn(self):
         self.get_pia_connections()
-        self.random_con = self.pick_rand_con()
-        while self.random_con in self.active_pia:
-            self.random_con = self.pick_rand_con()
+        candidates = [i for i in self.cons if i not in self.active_pia]
+        if not candidates:
+            raise IndexError('no PIA connection available to shuffle to')
+        self.random_con = random.choice(candidates)
         self.make_connection(self.random_con)
 
     def disconnect_vpn(self):
-        active_cons = subprocess.check_output(['nmcli', 'con', 'show', '--active']).decode('utf-8')
-        self.active_pia = []
-        for i in active_cons.split('\n'):
-            if re.search('\svpn\s', i):
-                vpn = re.split('\s+\S{36}\s+', i)[0]
-                if vpn.startswith('PIA'):
-                    self.active_pia.append(vpn)
-        for i in self.active_pia:
+        argv = ['nmcli', '-t', '-f', 'NAME,TYPE', 'con', 'show', '--active']
+        self.active_pia = set()
+        # parse lines as nmcli writes them rather than buffering all output
+        with subprocess.Popen(argv, stdout=subprocess.PIPE, encoding='utf-8') as proc:
+            for i in proc.stdout:
+                # terse output is NAME:TYPE with any ':' in NAME escaped as '\:'
+                name, sep, con_type = i.rstrip('\n').rpartition(':')
+                name = name.replace('\\:', ':')
+                if sep and con_type == 'vpn' and name.startswith('PIA'):
+                    self.active_pia.add(name)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, argv)
+        if not self.active_pia:
+            return
+        active = sorted(self.active_pia)
+        for i in active:
             print('Disconnecting {}...'.format(i))
-            subprocess.call(['nmcli', 'con', 'down', 'id', i])
+        argv = ['nmcli', 'con', 'down']
+        for i in active:
+            argv += ['id', i]
+        if _spawn(argv) != 0 and len(active) > 1:
+            # older nmcli only takes a single connection per call, so take
+            # them down concurrently instead
+            _spawn_all([['nmcli', 'con', 'down', 'id', i] for i in active])
 
 
 class Latencies():
     """
-    Uses threads to ping all PIA VPN servers and then tabulates latencies.
+    Pings all PIA VPN servers and then tabulates latencies. Probes are sent
+    from this process with `icmplib` when installed, else from a single `fping`
+    process when available, otherwise from `ping` subprocesses run
+    concurrently by asyncio. icmplib and asyncio probe at most
+    `max_concurrent` servers at a time.
+
+    Only the `top` fastest servers are tabulated; pass `top=None` for all.
+
+    A history of each server's latency is kept in `CACHE_DIR`. Servers that
+    failed `max_failures` runs in a row are skipped for `failure_ttl` seconds
+    (runs in which no server answered don't count, and at least one server is
+    always pinged), and the fastest server is chosen by its exponentially weighted average
+    latency rather than by a single run.
     """
 
-    def __init__(self, region):
-        pia = PiaConfigurations()
-        self.configs = pia.configs_dict
-        self.q = Queue()
+    max_concurrent = 64
+    ping_count = 2
+    # latency assigned to servers that do not answer any probe
+    unreachable = float('inf')
+    history_alpha = 0.3
+    max_failures = 3
+    failure_ttl = 3600
+
+    def __init__(self, region, configs_dict, top=20):
+        self.configs = configs_dict
         self.latencies = {}
+        self.top = top
+        self.history_file = os.path.join(CACHE_DIR, 'latency_history.json')
+        self.load_history()
         self.get_ip_addresses(region)
+        self.skip_failing()
         print('Pinging all PIA servers. This might take a few seconds...\n')
-        self.threaded_pings()
+        self.ping_all()
+        self.update_history()
         self.get_fastest()
 
     def get_ip_addresses(self, region):
         conn = Connection(region)
         conn.get_pia_connections()
-        cons = [i.split(' - ')[-1] for i in conn.cons]
-        self.ip_addresses = {}
-        for k in self.configs:
-            if isinstance(self.configs[k], dict):
-                if self.configs[k].get('ping'):
-                    if self.configs[k]['name'] in cons:
-                        ip = self.configs[k]['ping'].split(':')[0]
-                        self.ip_addresses[ip] = self.configs[k]['name']
-                        self.q.put(ip)
-
-    def ping(self):
-        ip = self.q.get()
+        cons = {i.split(' - ', 1)[-1] for i in conn.cons}
+        self.ip_addresses = {v['ping'].split(':', 1)[0]: v['name'] for v in self.configs.values()
+                             if isinstance(v, dict) and v.get('ping') and v.get('name') in cons}
+        self.ip_list = list(self.ip_addresses)
+
+    async def _ping_one(self, ip, semaphore):
+        import asyncio
+        async with semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                'ping', '-c', str(self.ping_count), '-W', '1', '-i', '0.2', ip,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            result, _ = await proc.communicate()
+        try:
+            if proc.returncode == 0:
+                return float(result.decode('utf-8').split('=')[-1].split('/')[1])
+        except (IndexError, ValueError):
+            pass
+        # failed pings never win get_fastest
+        return self.unreachable
+
+    async def _ping_all(self):
+        import asyncio
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        avgs = await asyncio.gather(*(self._ping_one(ip, semaphore) for ip in self.ip_list))
+        self.latencies.update(zip(self.ip_list, avgs))
+
+    def ping_all(self):
+        if not self.ip_list:
+            # fping would read its targets from stdin
+            return
+        if self.icmp_pings():
+            return
+        if shutil.which('fping'):
+            self.fping()
+        else:
+            self.async_pings()
+
+    def icmp_pings(self):
+        """
+        Pings from this process with the optional `icmplib` package. Returns
+        False if it is not installed or ICMP sockets are not permitted.
+        """
         try:
-            result = subprocess.check_output(['ping', '-c', '5', ip]).decode('utf-8')
-            avg = float(result.split('=')[-1].split('/')[1])
-        except subprocess.CalledProcessError:
-            # if ping fails then set latency to arbitrarily high value
-            avg = 999999.99
-        self.latencies[ip] = avg
-        self.q.task_done()
-
-    def threaded_pings(self):
-        for i in range(len(self.q.queue)):
-            worker = Thread(target=self.ping)
-            worker.start()
-        self.q.join()
+            import icmplib
+        except ImportError:
+            return False
+        try:
+            hosts = icmplib.multiping(self.ip_list, count=self.ping_count, interval=0.1, timeout=1,
+                                      concurrent_tasks=self.max_concurrent, privileged=(os.geteuid() == 0))
+        except (icmplib.ICMPLibError, OSError) as e:
+            logger.info('icmplib pings unavailable ({}), falling back'.format(e))
+            return False
+        for host in hosts:
+            self.latencies[host.address] = host.avg_rtt if host.is_alive else self.unreachable
+        return True
+
+    def fping(self):
+        # fping exits non-zero when any host is unreachable, so don't check.
+        # with -q the per-host -C summaries are written to stderr
+        out = subprocess.run(['fping', '-C', str(self.ping_count), '-q', '-B', '1', '-r', '0'] +
+                             self.ip_list, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE).stderr.decode('utf-8')
+        for ip, rtts in _FPING_RE.findall(out):
+            if ip not in self.ip_addresses:
+                continue
+            try:
+                times = [float(i) for i in rtts.split() if i != '-']
+            except ValueError:
+                # not a summary line, e.g. a duplicate reply or ICMP error
+                continue
+            self.latencies[ip] = sum(times) / len(times) if times else self.unreachable
+        for ip in self.ip_list:
+            self.latencies.setdefault(ip, self.unreachable)
+
+    def async_pings(self):
+        import asyncio
+        asyncio.run(self._ping_all())
+
+    def load_history(self):
+        try:
+            with open(self.history_file, 'r') as f:
+                self.history = json.load(f)
+        except (OSError, ValueError):
+            self.history = {}
+
+    def skip_failing(self):
+        now = time.time()
+        skipped = {ip for ip in self.ip_list
+                   if self.history.get(ip, {}).get('fails', 0) >= self.max_failures and
+                   now - self.history[ip].get('last_fail', 0) < self.failure_ttl}
+        if len(skipped) == len(self.ip_list):
+            # never skip every server, there would be nothing left to choose from
+            return
+        for ip in skipped:
+            self.latencies[ip] = self.unreachable
+        self.ip_list = [ip for ip in self.ip_list if ip not in skipped]
+
+    def update_history(self):
+        now = time.time()
+        self.smoothed = {}
+        # when nothing answered, e.g. ICMP is blocked, blame the network rather
+        # than counting a failure against every server
+        any_alive = any(self.latencies.get(ip, self.unreachable) < self.unreachable
+                        for ip in self.ip_list)
+        if not any_alive:
+            return
+        for ip in self.ip_list:
+            entry = self.history.setdefault(ip, {'ewma': None, 'fails': 0})
+            latency = self.latencies.get(ip, self.unreachable)
+            if latency >= self.unreachable:
+                entry['fails'] = entry.get('fails', 0) + 1
+                entry['last_fail'] = now
+                continue
+            entry['fails'] = 0
+            if entry.get('ewma') is None:
+                entry['ewma'] = latency
+            else:
+                entry['ewma'] = self.history_alpha * latency + (1 - self.history_alpha) * entry['ewma']
+            self.smoothed[ip] = entry['ewma']
+        try:
+            _write_atomic(self.history_file, json.dumps(self.history))
+        except OSError:
+            logger.warning('Unable to save latency history in {}'.format(CACHE_DIR))
 
     def get_fastest(self):
-        fastest = min(self.latencies, key=self.latencies.get)
+        # prefer the smoothed latency of servers that answered this run
+        latencies = self.smoothed or self.latencies
+        fastest = min(latencies, key=latencies.get)
         self.fastest = 'PIA - ' + self.ip_addresses[fastest]
 
     def __repr__(self):
         return str(self.latencies)
 
     def __str__(self):
-        table = ' {:<20} {:<17} {:>11} \n'.format('name', 'ip', 'ping (ms)')
-        table += '-' * 52 + '\n'
-        for k in sorted(self.latencies, key=self.latencies.get):
-            j = k.split('.')
-            table += '| {:<18} | {:>3}.{:>3}.{:>3}.{:>3} | {:>9.2f} |\n' \
-                .format(self.ip_addresses[k], j[0], j[1], j[2], j[3],
-                        self.latencies[k])
-        return table
+        if self.top is None:
+            fastest = sorted(self.latencies, key=self.latencies.get)
+        else:
+            fastest = heapq.nsmallest(self.top, self.latencies, key=self.latencies.get)
+        row = '| {name:<18} | {ip:>15} | {latency:>9.2f} |'.format
+        rows = [' {:<20} {:<17} {:>11} '.format('name', 'ip', 'ping (ms)'), '-' * 52]
+        rows.extend(row(name=self.ip_addresses[k], ip=k, latency=self.latencies[k]) for k in fastest)
+        return '\n'.join(rows) + '\n'
 
 
 def main():
@@ -322,24 +735,32 @@ def main():
                         help='connect to network with lowest ping latency')
     parser.add_argument('-d', '--disconnect', action='store_true',
                         help='disconnect current PIA vpn connection')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='list every server with -p/-f instead of the 20 fastest')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='number of keyfiles to write in parallel with -i (default: 4 per cpu)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='ignore the cached pia server info and download it again')
     args = parser.parse_args()
 
     def print_help_and_exit():
         parser.print_help()
         parser.exit(1)
 
-    if not any(vars(args).values()):
+    # -r, -a, -j and --refresh only modify one of these
+    if not any([args.initialize, args.ping, args.shuffle, args.fastest, args.disconnect]):
         print_help_and_exit()
+    pia = None
     if args.initialize:
         distro = Distro()
         print('Your distro appears to be {}.'.format(distro.distro.upper()))
         distro.install_packages()
-        pia = PiaConfigurations()
+        pia = PiaConfigurations(refresh=True)
         pia.get_credentials()
         pia.copy_cert()
         pia.delete_old_configs()
-        for vpn_dict in pia.configs_dict.items():
-            Keyfile(vpn_dict, pia.username, pia.password)
+        # keyfile writes are I/O bound, so use more threads than cpus
+        pia.write_keyfiles(jobs=args.jobs or (os.cpu_count() or 1) * 4)
         distro.restart_network_manager()
         print("Creation of VPN config files was successful.\n")
     if not args.region:
@@ -348,16 +769,20 @@ def main():
         region = args.region
         if not any([args.ping, args.shuffle, args.fastest]):
             print_help_and_exit()
+    if args.ping or args.fastest:
+        if pia is None:
+            pia = PiaConfigurations(refresh=args.refresh)
+        top = None if args.all else 20
     conn = Connection(region)
     if args.disconnect:
         conn.disconnect_vpn()
     if args.fastest:
         conn.disconnect_vpn()
-        lat = Latencies(region)
+        lat = Latencies(region, pia.configs_dict, top=top)
         print(lat)
         conn.make_connection(lat.fastest)
     elif args.ping:
-        lat = Latencies(region)
+        lat = Latencies(region, pia.configs_dict, top=top)
         print(lat)
     if args.shuffle:
         conn.disconnect_vpn()
@@ -5,6 +5,7 @@ setup(
     packages = ['pypia'],
     version = '0.3.7',
     package_data = {'pypia': ['package_info.json']},
+    extras_require = {'icmp': ['icmplib'], 'stream': ['ijson>=3.1']},
     author = 'Dan Hallau',
     author_email = 'pia@hallau.us',
     url = 'https://github.com/dagrha/pypia',